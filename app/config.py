@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent  # <папка>/
@@ -7,4 +8,7 @@ DB_PATH = BASE_DIR / "app.db"
 TMP_DIR = BASE_DIR / "app" / ".tmp_uploads"
 TMP_TTL_SECONDS = 60 * 60  # 1 час
 MAX_UPLOAD_MB = 50
-PERM_DIR = BASE_DIR / "app" / "uploads"
\ No newline at end of file
+PERM_DIR = BASE_DIR / "app" / "uploads"
+
+# Параллельный парсинг PDF в /report (1 = без пула процессов, удобно в dev)
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
\ No newline at end of file
@@ -1,34 +1,80 @@
-import sqlite3
-from contextlib import contextmanager
-from .config import DB_PATH
-
-def _column_exists(conn: sqlite3.Connection, table: str, col: str) -> bool:
-    cur = conn.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    return col in cols
-
-def init_db() -> None:
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS uploads (
-            id TEXT PRIMARY KEY,
-            original_name TEXT NOT NULL,
-            stored_path TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            is_committed INTEGER NOT NULL DEFAULT 0
-        )
-        """)
-
-        # миграции для уже существующих БД
-        if not _column_exists(conn, "uploads", "is_committed"):
-            conn.execute("ALTER TABLE uploads ADD COLUMN is_committed INTEGER NOT NULL DEFAULT 0")
-
-        conn.commit()
-
-@contextmanager
-def db_conn():
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        yield conn
-    finally:
-        conn.close()
+import sqlite3
+import threading
+from contextlib import contextmanager
+from .config import DB_PATH
+
+# WAL: читатели не блокируются писателем; NORMAL безопасен в WAL-режиме
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+_local = threading.local()
+
+def _configure(conn: sqlite3.Connection) -> None:
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+
+def _column_exists(conn: sqlite3.Connection, table: str, col: str) -> bool:
+    cur = conn.execute(f"PRAGMA table_info({table})")
+    cols = [r[1] for r in cur.fetchall()]
+    return col in cols
+
+# поднимать при каждой новой миграции
+_SCHEMA_VERSION = 1
+
+def init_db() -> None:
+    with sqlite3.connect(DB_PATH) as conn:
+        _configure(conn)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            original_name TEXT NOT NULL,
+            stored_path TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            is_committed INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+
+        # user_version как быстрый путь: на актуальной схеме старт не
+        # сканирует table_info вообще
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < _SCHEMA_VERSION:
+            # миграции для уже существующих БД (созданных до user_version
+            # колонки проверяем по факту)
+            if not _column_exists(conn, "uploads", "is_committed"):
+                conn.execute("ALTER TABLE uploads ADD COLUMN is_committed INTEGER NOT NULL DEFAULT 0")
+
+            # результат парсинга сохраняем один раз при коммите файла
+            if not _column_exists(conn, "uploads", "parsed_json"):
+                conn.execute("ALTER TABLE uploads ADD COLUMN parsed_json TEXT")
+
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+        conn.commit()
+
+@contextmanager
+def db_conn():
+    """
+    Одно долгоживущее соединение на поток: без open/close и повторной
+    настройки журнала на каждый запрос.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # увеличенный кэш скомпилированных statement'ов (по умолчанию 128)
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
+        _configure(conn)
+        _local.conn = conn
+    try:
+        yield conn
+    except Exception:
+        # соединение переживает запрос: оборванную транзакцию откатываем,
+        # иначе она держит write-lock и доезжает с чужим commit'ом
+        conn.rollback()
+        raise
+
+if __name__ == "__main__":
+    # явная инициализация схемы отдельным шагом: python -m app.db
+    init_db()
@@ -1,247 +1,314 @@
-from pathlib import Path
-import re
-from datetime import datetime
-from typing import Optional
-
-from fastapi import FastAPI, Request, UploadFile, File
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from fastapi.middleware.gzip import GZipMiddleware
-from pydantic import BaseModel
-
-from .db import init_db
-from .storage import (
-    cleanup_expired_files,
-    save_temp_pdf,
-    get_upload_meta,
-    list_uploads,
-    file_exists,
-    commit_uploads
-)
-from .parser import parse_report_pdf
-
-BASE_APP_DIR = Path(__file__).resolve().parent
-templates = Jinja2Templates(directory=str(BASE_APP_DIR / "templates"))
-
-app = FastAPI(title="PDF Dashboard")
-app.add_middleware(GZipMiddleware, minimum_size=1000)
-
-app.mount("/static", StaticFiles(directory=str(BASE_APP_DIR / "static")), name="static")
-
-
-# -----------------------------
-# Helpers for /report sorting
-# -----------------------------
-RE_PERIOD_RANGE = re.compile(
-    r"(?P<s>\d{2}\.\d{2}\.\d{4})\s*-\s*(?P<e>\d{2}\.\d{2}\.\d{4})"
-)
-
-def _period_start(period: str) -> datetime:
-    m = RE_PERIOD_RANGE.search(period or "")
-    if not m:
-        return datetime.max
-    return datetime.strptime(m.group("s"), "%d.%m.%Y")
-
-
-@app.on_event("startup")
-def on_startup():
-    init_db()
-    cleanup_expired_files()
-
-
-@app.get("/", response_class=HTMLResponse)
-def page_index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
-
-
-@app.get("/history", response_class=HTMLResponse)
-def page_history(request: Request):
-    cleanup_expired_files()
-    items = list_uploads()
-    for it in items:
-        it["available"] = file_exists(it["path"])
-    return templates.TemplateResponse("history.html", {"request": request, "items": items})
-
-
-@app.get("/file/{upload_id}", response_class=HTMLResponse)
-def page_file(request: Request, upload_id: str):
-    meta = get_upload_meta(upload_id)
-    if not meta:
-        return RedirectResponse(url="/history", status_code=302)
-
-    available = file_exists(meta["path"])
-    parsed = parse_report_pdf(meta["path"]) if available else None
-
-    return templates.TemplateResponse(
-        "file.html",
-        {"request": request, "meta": meta, "available": available, "parsed": parsed}
-    )
-
-
-# --- API ---
-
-@app.post("/api/upload")
-async def api_upload(file: UploadFile = File(...)):
-    cleanup_expired_files()
-    payload = await save_temp_pdf(file)
-    return JSONResponse(payload)
-
-
-@app.get("/api/preview/{upload_id}")
-def api_preview(upload_id: str):
-    meta = get_upload_meta(upload_id)
-    if not meta or not file_exists(meta["path"]):
-        return JSONResponse({"detail": "File not found (expired or missing)"}, status_code=404)
-
-    headers = {
-        "Cache-Control": "no-store",
-        "Content-Disposition": f'inline; filename="{meta["name"]}"'
-    }
-
-    return FileResponse(
-        meta["path"],
-        media_type="application/pdf",
-        headers=headers
-    )
-
-
-@app.get("/viewer/{upload_id}", response_class=HTMLResponse)
-def page_viewer(request: Request, upload_id: str):
-    meta = get_upload_meta(upload_id)
-    if not meta or not file_exists(meta["path"]):
-        return HTMLResponse("Not found", status_code=404)
-
-    return templates.TemplateResponse("viewer.html", {
-        "request": request,
-        "pdf_url": f"/api/preview/{upload_id}"
-    })
-
-
-class CommitBody(BaseModel):
-    ids: list[str]
-
-
-@app.post("/api/commit")
-def api_commit(body: CommitBody):
-    result = commit_uploads(body.ids)
-    return JSONResponse(result)
-
-
-@app.get("/report", response_class=HTMLResponse)
-def page_report(request: Request):
-    files = list_uploads(limit=500)  # committed only (если вы так настроили list_uploads)
-
-    parsed_files = []
-    for f in files:
-        if not file_exists(f["path"]):
-            continue
-
-        parsed = parse_report_pdf(f["path"])
-        period = (parsed.get("period") or "").strip()
-        region = (parsed.get("region") or "").strip()
-        report_date = (parsed.get("report_date") or "").strip()
-        rows = parsed.get("rows", []) or []
-
-        parsed_files.append({
-            "period": period,
-            "period_start": _period_start(period),
-            "region": region,
-            "report_date": report_date,
-            "rows": rows,
-        })
-
-    # Самый ранний период первым (январь -> февраль -> март)
-    parsed_files.sort(key=lambda x: x["period_start"])
-
-    # PERIOD -> DATA(этого файла) -> PERIOD -> DATA(следующего файла) ...
-    table_rows = []
-    seen = set()  # дедуп по всем параметрам (на всякий случай)
-
-    for pf in parsed_files:
-        period = pf["period"]
-
-        # строка периода ПЕРЕД данными файла
-        table_rows.append({"type": "period", "period": period})
-
-        # строки файла
-        for r in pf["rows"]:
-            key = (
-                period,
-                pf["region"],
-                pf["report_date"],
-                r.get("pay_no", ""),   # чтобы одинаковые строки с разными платежками не склеивались
-                r.get("iin_bin", ""),
-                r.get("bank_code", ""),
-                r.get("iik", ""),
-                r.get("kbk", ""),
-                r.get("amount_in", ""),
-            )
-            if key in seen:
-                continue
-            seen.add(key)
-
-            table_rows.append({
-                "type": "data",
-                "iin_bin": r.get("iin_bin", ""),
-                "bank_code": r.get("bank_code", ""),
-                "iik": r.get("iik", ""),
-                "kbk": r.get("kbk", ""),
-                "amount_in": r.get("amount_in", ""),
-            })
-
-    return templates.TemplateResponse("report.html", {
-        "request": request,
-        "rows": table_rows,
-        "files_count": len(parsed_files)
-    })
-
-
-@app.get("/api/report/data")
-def api_report_data():
-    """API endpoint for charts and filters data"""
-    files = list_uploads(limit=500)
-    
-    parsed_files = []
-    for f in files:
-        if not file_exists(f["path"]):
-            continue
-        
-        parsed = parse_report_pdf(f["path"])
-        period = (parsed.get("period") or "").strip()
-        region = (parsed.get("region") or "").strip()
-        report_date = (parsed.get("report_date") or "").strip()
-        rows = parsed.get("rows", []) or []
-        
-        # Clean amount strings for numeric calculations
-        cleaned_rows = []
-        for r in rows:
-            cleaned_rows.append({
-                "iin_bin": r.get("iin_bin", ""),
-                "bank_code": r.get("bank_code", ""),
-                "iik": r.get("iik", ""),
-                "kbk": r.get("kbk", ""),
-                "amount_in": r.get("amount_in", ""),
-                "amount_numeric": float(r.get("amount_in", "0").replace(",", "")) if r.get("amount_in") else 0.0
-            })
-        
-        parsed_files.append({
-            "period": period,
-            "period_start": _period_start(period).isoformat() if period else "",
-            "region": region,
-            "report_date": report_date,
-            "rows": cleaned_rows,
-        })
-    
-    # Sort by period
-    parsed_files.sort(key=lambda x: x["period_start"])
-    
-    return {
-        "files": parsed_files,
-        "total_files": len(parsed_files),
-        "available_regions": list(set([f["region"] for f in parsed_files if f["region"]])),
-        "available_periods": list(set([f["period"] for f in parsed_files if f["period"]])),
-        "available_kbks": list(set([
-            r["kbk"] for f in parsed_files for r in f["rows"] if r["kbk"]
-        ]))
-    }
+from pathlib import Path
+import asyncio
+import json
+import re
+import threading
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+
+from fastapi import FastAPI, Request, UploadFile, File
+from fastapi.responses import (
+    HTMLResponse,
+    FileResponse,
+    JSONResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    StreamingResponse
+)
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel
+from cachetools import TTLCache
+
+from .db import init_db
+from .storage import (
+    cleanup_expired_files,
+    save_temp_pdf,
+    get_upload_meta,
+    list_uploads,
+    file_exists,
+    commit_uploads
+)
+from .parse_cache import get_parsed, get_parsed_many
+from .parser import row_digest
+
+BASE_APP_DIR = Path(__file__).resolve().parent
+templates = Jinja2Templates(directory=str(BASE_APP_DIR / "templates"))
+
+# orjson сериализует большие отчётные payload'ы в разы быстрее stdlib json
+app = FastAPI(title="PDF Dashboard", default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+app.mount("/static", StaticFiles(directory=str(BASE_APP_DIR / "static")), name="static")
+
+
+# -----------------------------
+# Helpers for /report sorting
+# -----------------------------
+RE_PERIOD_RANGE = re.compile(
+    r"(?P<s>\d{2}\.\d{2}\.\d{4})\s*-\s*(?P<e>\d{2}\.\d{2}\.\d{4})"
+)
+
+_STRIP_COMMAS = str.maketrans("", "", ",")
+
+# одни и те же периоды повторяются из файла в файл — мемоизируем
+@lru_cache(maxsize=1024)
+def _period_start(period: str) -> datetime:
+    m = RE_PERIOD_RANGE.search(period or "")
+    if not m:
+        return datetime.max
+    s = m.group("s")
+    # ручной разбор dd.mm.yyyy: без локали и блокировок strptime
+    return datetime(int(s[6:10]), int(s[3:5]), int(s[0:2]))
+
+
+def _parsed_many(files: list[dict]) -> list[dict]:
+    """
+    Достаёт результаты парсинга: сначала parsed_json из БД (заполняется при
+    коммите); файлы без него (закоммиченные до миграции) парсятся пачкой
+    через кэш с пулом процессов.
+    """
+    missing = [f["path"] for f in files if not f.get("parsed_json")]
+    by_path = dict(zip(missing, get_parsed_many(missing))) if missing else {}
+    return [
+        json.loads(f["parsed_json"]) if f.get("parsed_json") else by_path[f["path"]]
+        for f in files
+    ]
+
+
+async def _ttl_loop():
+    # периодическая чистка в фоне: запросы больше не платят за скан каталога
+    while True:
+        await asyncio.to_thread(cleanup_expired_files)
+        await asyncio.sleep(300)
+
+
+@app.on_event("startup")
+async def on_startup():
+    init_db()
+    asyncio.create_task(_ttl_loop())
+
+
+@app.get("/", response_class=HTMLResponse)
+def page_index(request: Request):
+    return templates.TemplateResponse("index.html", {"request": request})
+
+
+@app.get("/history", response_class=HTMLResponse)
+def page_history(request: Request):
+    items = list_uploads()
+    for it in items:
+        it["available"] = file_exists(it["path"])
+    return templates.TemplateResponse("history.html", {"request": request, "items": items})
+
+
+@app.get("/file/{upload_id}", response_class=HTMLResponse)
+def page_file(request: Request, upload_id: str):
+    meta = get_upload_meta(upload_id)
+    if not meta:
+        return RedirectResponse(url="/history", status_code=302)
+
+    available = file_exists(meta["path"])
+    parsed = get_parsed(meta["path"]) if available else None
+
+    return templates.TemplateResponse(
+        "file.html",
+        {"request": request, "meta": meta, "available": available, "parsed": parsed}
+    )
+
+
+# --- API ---
+
+@app.post("/api/upload")
+async def api_upload(file: UploadFile = File(...)):
+    payload = await save_temp_pdf(file)
+    return JSONResponse(payload)
+
+
+@app.get("/api/preview/{upload_id}")
+def api_preview(upload_id: str):
+    meta = get_upload_meta(upload_id)
+    if not meta or not file_exists(meta["path"]):
+        return JSONResponse({"detail": "File not found (expired or missing)"}, status_code=404)
+
+    headers = {
+        "Cache-Control": "no-store",
+        "Content-Disposition": f'inline; filename="{meta["name"]}"'
+    }
+
+    return FileResponse(
+        meta["path"],
+        media_type="application/pdf",
+        headers=headers
+    )
+
+
+@app.get("/viewer/{upload_id}", response_class=HTMLResponse)
+def page_viewer(request: Request, upload_id: str):
+    meta = get_upload_meta(upload_id)
+    if not meta or not file_exists(meta["path"]):
+        return HTMLResponse("Not found", status_code=404)
+
+    return templates.TemplateResponse("viewer.html", {
+        "request": request,
+        "pdf_url": f"/api/preview/{upload_id}"
+    })
+
+
+class CommitBody(BaseModel):
+    ids: list[str]
+
+
+@app.post("/api/commit")
+def api_commit(body: CommitBody):
+    result = commit_uploads(body.ids)
+    with _report_lock:
+        _report_cache.clear()  # состав отчёта изменился
+    return JSONResponse(result)
+
+
+# Общий payload для /report и /api/report/data: страница отчёта тянет оба
+# эндпоинта, без кэша каждый прогон собирал бы одно и то же дважды.
+# Ключ включает (кол-во файлов, максимальный mtime), так что новые коммиты
+# инвалидируют запись и без явного clear.
+_report_cache: TTLCache = TTLCache(maxsize=4, ttl=60)
+# TTLCache не потокобезопасен, а /report и /api/report/data приходят парой;
+# single-flight: payload строит один поток, остальные ждут готовый
+_report_lock = threading.Lock()
+
+
+def _build_report_payload() -> dict:
+    """
+    Собирает отчётный payload один раз для обоих эндпоинтов. Блокирующая
+    часть (чтение файлов, парсинг некэшированных PDF) — выносится из
+    event loop вызывающим.
+    """
+    files = list_uploads(limit=500, include_parsed=True)  # committed only (если вы так настроили list_uploads)
+    files = [f for f in files if file_exists(f["path"])]
+
+    key = (
+        len(files),
+        max((Path(f["path"]).stat().st_mtime_ns for f in files), default=0),
+    )
+    with _report_lock:
+        payload = _report_cache.get(key)
+        if payload is not None:
+            return payload
+        return _build_report_payload_locked(files, key)
+
+
+def _build_report_payload_locked(files: list[dict], key: tuple) -> dict:
+    parsed_files = []
+    for parsed in _parsed_many(files):
+        period = (parsed.get("period") or "").strip()
+        region = (parsed.get("region") or "").strip()
+        report_date = (parsed.get("report_date") or "").strip()
+        rows = parsed.get("rows", []) or []
+
+        # Clean amount strings for numeric calculations
+        cleaned_rows = []
+        for r in rows:
+            # amount_numeric кладёт парсер; fallback — для parsed_json,
+            # сохранённого до этого изменения
+            amount_numeric = r.get("amount_numeric")
+            if amount_numeric is None:
+                a = r.get("amount_in", "")
+                amount_numeric = float(a.translate(_STRIP_COMMAS)) if a else 0.0
+
+            cleaned_rows.append({
+                "pay_no": r.get("pay_no", ""),
+                "iin_bin": r.get("iin_bin", ""),
+                "bank_code": r.get("bank_code", ""),
+                "iik": r.get("iik", ""),
+                "kbk": r.get("kbk", ""),
+                "amount_in": r.get("amount_in", ""),
+                "amount_numeric": amount_numeric
+            })
+
+        parsed_files.append({
+            "period": period,
+            "period_start": _period_start(period).isoformat() if period else "",
+            "region": region,
+            "report_date": report_date,
+            "rows": cleaned_rows,
+        })
+
+    # Самый ранний период первым (январь -> февраль -> март);
+    # нераспознанный период ("") — в конец, как раньше с datetime.max
+    parsed_files.sort(key=lambda x: x["period_start"] or "9999")
+
+    payload = {
+        "files": parsed_files,
+        "total_files": len(parsed_files),
+        "available_regions": list(set([f["region"] for f in parsed_files if f["region"]])),
+        "available_periods": list(set([f["period"] for f in parsed_files if f["period"]])),
+        "available_kbks": list(set([
+            r["kbk"] for f in parsed_files for r in f["rows"] if r["kbk"]
+        ]))
+    }
+    _report_cache[key] = payload
+    return payload
+
+
+def _iter_report_rows(parsed_files: list[dict]):
+    """
+    PERIOD -> DATA(этого файла) -> PERIOD -> DATA(следующего файла) ...
+    Генератор: строки не материализуются целиком, Jinja рендерит по ходу.
+    """
+    # дедуп между файлами с одинаковой шапкой; внутри файла строки уже
+    # уникальны после парсера. Ключ — один xxh3-дайджест вместо кортежа.
+    seen: set[int] = set()
+
+    for pf in parsed_files:
+        period = pf["period"]
+
+        # строка периода ПЕРЕД данными файла
+        yield {"type": "period", "period": period}
+
+        # строки файла
+        for r in pf["rows"]:
+            key = row_digest(
+                period,
+                pf["region"],
+                pf["report_date"],
+                r.get("pay_no", ""),   # чтобы одинаковые строки с разными платежками не склеивались
+                r.get("iin_bin", ""),
+                r.get("bank_code", ""),
+                r.get("iik", ""),
+                r.get("kbk", ""),
+                r.get("amount_in", ""),
+            )
+            if key in seen:
+                continue
+            seen.add(key)
+
+            yield {
+                "type": "data",
+                "iin_bin": r.get("iin_bin", ""),
+                "bank_code": r.get("bank_code", ""),
+                "iik": r.get("iik", ""),
+                "kbk": r.get("kbk", ""),
+                "amount_in": r.get("amount_in", ""),
+            }
+
+
+@app.get("/report", response_class=HTMLResponse)
+async def page_report(request: Request):
+    payload = await asyncio.to_thread(_build_report_payload)
+
+    # потоковый рендер: чанки HTML уходят клиенту по мере генерации
+    template = templates.get_template("report.html")
+    stream = template.generate(
+        request=request,
+        rows=_iter_report_rows(payload["files"]),
+        files_count=payload["total_files"]
+    )
+    return StreamingResponse(stream, media_type="text/html")
+
+
+@app.get("/api/report/data")
+async def api_report_data():
+    """API endpoint for charts and filters data"""
+    return await asyncio.to_thread(_build_report_payload)
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+from .config import PARSE_WORKERS
+from .parser import parse_report_pdf
+
+# Кэш разобранных PDF: ключ включает mtime и размер, поэтому при замене
+# файла на диске запись автоматически "протухает".
+_MAX_CACHE = 512
+_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+# кэш дёргают и threadpool-обработчики (/file), и сборка отчёта — мутируем
+# OrderedDict только под локом
+_lock = threading.Lock()
+
+# Пул процессов для параллельного парсинга (создаётся лениво)
+_pool: ProcessPoolExecutor | None = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+        return _pool
+
+
+def _cache_key(path: str) -> tuple:
+    st = Path(path).stat()
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def _remember(key: tuple, parsed: dict) -> None:
+    _cache[key] = parsed
+    _cache.move_to_end(key)
+    while len(_cache) > _MAX_CACHE:
+        _cache.popitem(last=False)
+
+
+def _parse_file(path: str) -> dict:
+    # читаем файл целиком один раз — парсер работает по байтам в памяти
+    return parse_report_pdf(Path(path).read_bytes())
+
+
+def get_parsed(path: str) -> dict:
+    key = _cache_key(path)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    parsed = _parse_file(path)
+    with _lock:
+        _remember(key, parsed)
+    return parsed
+
+
+def get_parsed_many(paths: List[str]) -> List[dict]:
+    """
+    Парсит список файлов; некэшированные раскидываются по ядрам
+    (каждый файл независим, парсинг — CPU-bound).
+    """
+    keys = [_cache_key(p) for p in paths]
+
+    # результаты собираем локально: параллельная вставка может вытеснить
+    # ключ из _cache раньше, чем мы его прочитаем
+    found: dict = {}
+    with _lock:
+        for k in keys:
+            if k in _cache:
+                _cache.move_to_end(k)
+                found[k] = _cache[k]
+
+    todo = [(p, k) for p, k in zip(paths, keys) if k not in found]
+    if todo:
+        todo_paths = [p for p, _ in todo]
+        if PARSE_WORKERS > 1 and len(todo_paths) > 1:
+            results = list(_get_pool().map(_parse_file, todo_paths, chunksize=4))
+        else:
+            results = [_parse_file(p) for p in todo_paths]
+        with _lock:
+            for (_, key), parsed in zip(todo, results):
+                _remember(key, parsed)
+                found[key] = parsed
+
+    return [found[k] for k in keys]
@@ -1,157 +1,219 @@
-import re
-from typing import Any, List, Dict
-import pdfplumber
-
-RE_REGION = re.compile(r"Регион:\s*(.+)")
-RE_REPORT_DATE = re.compile(r"Отчет произведен:\s*([0-9]{2}\.[0-9]{2}\.[0-9]{4}\s+[0-9]{2}:[0-9]{2}:[0-9]{2})")
-RE_PERIOD = re.compile(r"Период:\s*([0-9]{2}\.[0-9]{2}\.[0-9]{4}\s*-\s*[0-9]{2}\.[0-9]{2}\.[0-9]{4})")
-
-def _clean_text(t: str) -> str:
-    t = (t or "").replace("\u00A0", " ")
-    t = re.sub(r"[ \t]+", " ", t)
-    return t.strip()
-
-def _extract_meta(full_text: str) -> Dict[str, str]:
-    region = ""
-    report_date = ""
-    period = ""
-
-    m = RE_REGION.search(full_text)
-    if m:
-        region = m.group(1).strip()
-
-    m = RE_REPORT_DATE.search(full_text)
-    if m:
-        report_date = m.group(1).strip()
-
-    m = RE_PERIOD.search(full_text)
-    if m:
-        period = m.group(1).strip()
-
-    return {"region": region, "report_date": report_date, "period": period}
-
-def _parse_rows_by_columns(page) -> List[Dict[str, str]]:
-    """
-    Парсит строки таблицы по координатам колонок, устойчиво к переносам.
-    Нужные поля:
-    - ИИН/БИН (12 цифр)
-    - Код банка (7 символов + буква на следующей строке)
-    - ИИК (KZ + 18 символов, часто продолжение на следующих строках)
-    - КБК (6 цифр)
-    - Сумма (xxx,xxx.xx)
-    """
-    words = page.extract_words()
-    # ИИН/БИН всегда отдельным словом (12 цифр)
-    iin_words = [w for w in words if re.fullmatch(r"\d{12}", w["text"])]
-    iin_words = sorted(iin_words, key=lambda w: w["top"])
-
-    rows = []
-    for idx, iw in enumerate(iin_words):
-        top = iw["top"]
-        next_top = iin_words[idx + 1]["top"] if idx + 1 < len(iin_words) else 10**9
-
-        # 1) Берём "основную" строку записи (где стоит ИИН)
-        line = [w for w in words if abs(w["top"] - top) < 2.5]
-        line = sorted(line, key=lambda w: w["x0"])
-
-        iin = iw["text"]
-        pay_no = ""
-        bank_base = ""
-        iik_prefix = ""
-        kbk = ""
-        amount = ""
-
-        # По координатам колонок (под ваш PDF)
-        for w in line:
-            t = w["text"]
-            # Код банка (часто 7 символов в этой строке)
-            if 320 <= w["x0"] <= 385 and re.fullmatch(r"[A-Z0-9]{7,8}", t):
-                bank_base = t
-
-            # ИИК префикс (KZ + 5 символов)
-            if 385 <= w["x0"] <= 470 and re.fullmatch(r"KZ[0-9A-Z]{5}", t):
-                iik_prefix = t
-
-            # КБК (6 цифр) — в вашем PDF стоит около x0 ~ 442
-            if 420 <= w["x0"] <= 500 and re.fullmatch(r"\d{6}", t):
-                kbk = t
-
-            # Сумма — около x0 ~ 528
-            if w["x0"] >= 505 and re.fullmatch(r"\d[\d,]*\.\d{2}", t):
-                amount = t
-        
-        # Номер платежного поручения (может быть "226*" и т.п.)
-        for w in line:
-            t = w["text"]
-            if re.fullmatch(r"\d+\*?", t):
-                pay_no = t
-                break
-
-        # 2) Собираем продолжения до следующего ИИН (там обычно лежат:
-        #    - последняя буква кода банка
-        #    - остаток ИИК (может содержать буквы/цифры)
-        between = [w for w in words if top < w["top"] < next_top]
-        between = sorted(between, key=lambda w: (w["top"], w["x0"]))
-
-        # Суффикс кода банка (одна буква в колонке банка)
-        suffix = ""
-        for w in between:
-            if 320 <= w["x0"] <= 385 and re.fullmatch(r"[A-Z]", w["text"]):
-                suffix = w["text"]
-                break
-
-        bank_code = bank_base
-        if bank_base and len(bank_base) == 7 and suffix:
-            bank_code = bank_base + suffix
-
-        # Остаток ИИК: берём токены в колонке ИИК (могут быть A2910013 и т.п.)
-        cont_parts = []
-        for w in between:
-            if 385 <= w["x0"] <= 470 and re.fullmatch(r"[0-9A-Z]+", w["text"]):
-                cont_parts.append(w["text"])
-
-        iik = (iik_prefix or "") + "".join(cont_parts)
-        # Казахстанский ИИК обычно длиной 20 (KZ + 18)
-        if len(iik) > 20:
-            iik = iik[:20]
-
-        # если что-то ключевое не нашли — всё равно добавим строку, но пустое поле будет видно
-        rows.append({
-            "pay_no": pay_no,
-            "iin_bin": iin,
-            "bank_code": bank_code,
-            "iik": iik,
-            "kbk": kbk,
-            "amount_in": amount
-        })
-
-    # дедупликация (в PDF могут повторяться строки из-за повторов блоков)
-    uniq = []
-    seen = set()
-    for r in rows:
-        key = (r.get("pay_no",""), r["iin_bin"], r["bank_code"], r["iik"], r["kbk"], r["amount_in"])
-        if key in seen:
-            continue
-        seen.add(key)
-        uniq.append(r)
-
-    return uniq
-
-def parse_report_pdf(pdf_path: str) -> dict[str, Any]:
-    pages_text = []
-    all_rows = []
-
-    with pdfplumber.open(pdf_path) as pdf:
-        for p in pdf.pages:
-            pages_text.append(p.extract_text() or "")
-            all_rows.extend(_parse_rows_by_columns(p))
-
-    full_text = _clean_text("\n".join(pages_text))
-    meta = _extract_meta(full_text)
-
-    return {
-        "region": meta["region"],
-        "report_date": meta["report_date"],
-        "period": meta["period"],
-        "rows": all_rows
-    }
+import re
+from typing import Any, List, Dict, NamedTuple
+import numpy as np
+import pymupdf
+import xxhash
+
+
+def row_digest(*parts: str) -> int:
+    # компактный ключ дедупликации: один xxh3 вместо кортежа строк
+    return xxhash.xxh3_64_intdigest(b"\x1f".join(p.encode() for p in parts))
+
+
+class Word(NamedTuple):
+    x0: float
+    top: float
+    text: str
+
+RE_REGION = re.compile(r"Регион:\s*(.+)")
+RE_REPORT_DATE = re.compile(r"Отчет произведен:\s*([0-9]{2}\.[0-9]{2}\.[0-9]{4}\s+[0-9]{2}:[0-9]{2}:[0-9]{2})")
+RE_PERIOD = re.compile(r"Период:\s*([0-9]{2}\.[0-9]{2}\.[0-9]{4}\s*-\s*[0-9]{2}\.[0-9]{2}\.[0-9]{4})")
+
+_STRIP_COMMAS = str.maketrans("", "", ",")
+
+# Паттерны горячего цикла парсинга строк — компилируем один раз на модуль
+_RE_WS = re.compile(r"[ \t]+")
+_RE_BANK = re.compile(r"[A-Z0-9]{7,8}")
+_RE_IIK_PREFIX = re.compile(r"KZ[0-9A-Z]{5}")
+_RE_AMOUNT = re.compile(r"\d[\d,]*\.\d{2}")
+_RE_PAY_NO = re.compile(r"\d+\*?")
+_RE_ALNUM = re.compile(r"[0-9A-Z]+")
+
+def _clean_text(t: str) -> str:
+    t = (t or "").replace("\u00A0", " ")
+    t = _RE_WS.sub(" ", t)
+    return t.strip()
+
+def _extract_meta(full_text: str) -> Dict[str, str]:
+    region = ""
+    report_date = ""
+    period = ""
+
+    m = RE_REGION.search(full_text)
+    if m:
+        region = m.group(1).strip()
+
+    m = RE_REPORT_DATE.search(full_text)
+    if m:
+        report_date = m.group(1).strip()
+
+    m = RE_PERIOD.search(full_text)
+    if m:
+        period = m.group(1).strip()
+
+    return {"region": region, "report_date": report_date, "period": period}
+
+def _words_to_text(words: List[Word]) -> str:
+    """
+    Восстанавливает текст страницы из уже извлечённых слов: строки по
+    y-координате, слова слева направо. Нужен только для _extract_meta,
+    поэтому второй проход get_text("text") по странице не делаем.
+    """
+    ordered = sorted(words, key=lambda w: (w.top, w.x0))
+    lines: List[str] = []
+    cur: List[str] = []
+    cur_top = None
+
+    for w in ordered:
+        if cur_top is not None and abs(w.top - cur_top) >= 2.5:
+            lines.append(" ".join(cur))
+            cur = []
+            cur_top = w.top
+        elif cur_top is None:
+            cur_top = w.top
+        cur.append(w.text)
+
+    if cur:
+        lines.append(" ".join(cur))
+
+    return "\n".join(lines)
+
+def _parse_rows_by_columns(words: List[Word]) -> List[Dict[str, str]]:
+    """
+    Парсит строки таблицы по координатам колонок, устойчиво к переносам.
+    Нужные поля:
+    - ИИН/БИН (12 цифр)
+    - Код банка (7 символов + буква на следующей строке)
+    - ИИК (KZ + 18 символов, часто продолжение на следующих строках)
+    - КБК (6 цифр)
+    - Сумма (xxx,xxx.xx)
+    """
+    n = len(words)
+    if n == 0:
+        return []
+
+    # SoA вместо списка кортежей: координаты — NumPy-массивы, выборки
+    # строки/продолжений и принадлежность колонкам — векторные маски
+    xs = np.fromiter((w.x0 for w in words), dtype=np.float64, count=n)
+    tops = np.fromiter((w.top for w in words), dtype=np.float64, count=n)
+    texts = [w.text for w in words]
+
+    # маски колонок считаются один раз на страницу
+    in_bank = (xs >= 320) & (xs <= 385)
+    in_iik = (xs >= 385) & (xs <= 470)
+    in_kbk = (xs >= 420) & (xs <= 500)
+    in_amount = xs >= 505
+
+    # ИИН/БИН всегда отдельным словом (12 цифр)
+    iin_idx = [i for i, t in enumerate(texts) if len(t) == 12 and t.isdigit()]
+    iin_idx.sort(key=lambda i: tops[i])
+
+    rows = []
+    for pos, i in enumerate(iin_idx):
+        top = tops[i]
+        next_top = tops[iin_idx[pos + 1]] if pos + 1 < len(iin_idx) else np.inf
+
+        # 1) Берём "основную" строку записи (где стоит ИИН)
+        line = np.nonzero(np.abs(tops - top) < 2.5)[0]
+        line = line[np.argsort(xs[line], kind="stable")]
+
+        iin = texts[i]
+        pay_no = ""
+        bank_base = ""
+        iik_prefix = ""
+        kbk = ""
+        amount = ""
+
+        for j in line:
+            t = texts[j]
+            # Код банка (часто 7 символов в этой строке)
+            if in_bank[j] and _RE_BANK.fullmatch(t):
+                bank_base = t
+
+            # ИИК префикс (KZ + 5 символов)
+            if in_iik[j] and _RE_IIK_PREFIX.fullmatch(t):
+                iik_prefix = t
+
+            # КБК (6 цифр) — в вашем PDF стоит около x0 ~ 442
+            if in_kbk[j] and len(t) == 6 and t.isdigit():
+                kbk = t
+
+            # Сумма — около x0 ~ 528
+            if in_amount[j] and _RE_AMOUNT.fullmatch(t):
+                amount = t
+
+            # Номер платежного поручения (может быть "226*" и т.п.);
+            # line отсортирована по x0, первый подошедший — тот же, что
+            # находил отдельный проход
+            if not pay_no and _RE_PAY_NO.fullmatch(t):
+                pay_no = t
+
+        # 2) Собираем продолжения до следующего ИИН (там обычно лежат:
+        #    - последняя буква кода банка
+        #    - остаток ИИК (может содержать буквы/цифры)
+        between = np.nonzero((tops > top) & (tops < next_top))[0]
+        between = between[np.lexsort((xs[between], tops[between]))]
+
+        # Один проход по продолжениям: суффикс кода банка (одна буква в
+        # колонке банка) и остаток ИИК (токены вида A2910013 и т.п.)
+        suffix = ""
+        cont_parts = []
+        for j in between:
+            t = texts[j]
+            if not suffix and in_bank[j] and len(t) == 1 and "A" <= t <= "Z":
+                suffix = t
+            if in_iik[j] and _RE_ALNUM.fullmatch(t):
+                cont_parts.append(t)
+
+        bank_code = bank_base
+        if bank_base and len(bank_base) == 7 and suffix:
+            bank_code = bank_base + suffix
+
+        iik = (iik_prefix or "") + "".join(cont_parts)
+        # Казахстанский ИИК обычно длиной 20 (KZ + 18)
+        if len(iik) > 20:
+            iik = iik[:20]
+
+        # если что-то ключевое не нашли — всё равно добавим строку, но пустое поле будет видно
+        rows.append({
+            "pay_no": pay_no,
+            "iin_bin": iin,
+            "bank_code": bank_code,
+            "iik": iik,
+            "kbk": kbk,
+            "amount_in": amount,
+            # числовое значение считаем здесь один раз, отчёты его не пересчитывают
+            "amount_numeric": float(amount.translate(_STRIP_COMMAS)) if amount else 0.0
+        })
+
+    # дедупликация (в PDF могут повторяться строки из-за повторов блоков)
+    uniq = []
+    seen: set[int] = set()
+    for r in rows:
+        key = row_digest(r.get("pay_no", ""), r["iin_bin"], r["bank_code"], r["iik"], r["kbk"], r["amount_in"])
+        if key in seen:
+            continue
+        seen.add(key)
+        uniq.append(r)
+
+    return uniq
+
+def parse_report_pdf(pdf_bytes: bytes) -> dict[str, Any]:
+    pages_text = []
+    all_rows = []
+
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for p in doc:
+            words = [Word(w[0], w[1], w[4]) for w in p.get_text("words")]
+            pages_text.append(_words_to_text(words))
+            all_rows.extend(_parse_rows_by_columns(words))
+
+    full_text = _clean_text("\n".join(pages_text))
+    meta = _extract_meta(full_text)
+
+    return {
+        "region": meta["region"],
+        "report_date": meta["report_date"],
+        "period": meta["period"],
+        "rows": all_rows
+    }
@@ -1,13 +1,15 @@
+import json
 import os
 import time
 import uuid
 from pathlib import Path
 from datetime import datetime, timezone
-import shutil
 
+import aiofiles
 from fastapi import UploadFile, HTTPException
 from .config import TMP_DIR, TMP_TTL_SECONDS, MAX_UPLOAD_MB, PERM_DIR
 from .db import db_conn
+from .parser import parse_report_pdf
 
 def ensure_tmp_dir() -> None:
     TMP_DIR.mkdir(parents=True, exist_ok=True)
@@ -44,11 +46,10 @@ async def save_temp_pdf(file: UploadFile) -> dict:
     max_bytes = MAX_UPLOAD_MB * 1024 * 1024
     total = 0
 
-    with stored_path.open("wb") as out:
-        while True:
-            chunk = await file.read(1024 * 1024)
-            if not chunk:
-                break
+    # aiofiles: запись не блокирует event loop, параллельные загрузки
+    # реально перекрываются; крупные чанки амортизируют Python-накладные
+    async with aiofiles.open(stored_path, "wb") as out:
+        while chunk := await file.read(4 * 1024 * 1024):
             total += len(chunk)
             if total > max_bytes:
                 try:
@@ -56,7 +57,7 @@ async def save_temp_pdf(file: UploadFile) -> dict:
                 except Exception:
                     pass
                 raise HTTPException(status_code=413, detail=f"File too large (>{MAX_UPLOAD_MB}MB)")
-            out.write(chunk)
+            await out.write(chunk)
 
     created_at = utc_now_iso()
 
@@ -73,22 +74,32 @@ async def save_temp_pdf(file: UploadFile) -> dict:
         "preview_url": f"/api/preview/{upload_id}"
     }
 
+# Чистку зовут со многих запросов — чаще раза в минуту смысла нет
+_SWEEP_INTERVAL_SECONDS = 60
+_last_sweep = 0.0
+
 def cleanup_expired_files() -> int:
     """
     Удаляет файлы старше TTL (и не трогает записи истории — просто файл может стать 'expired').
     """
-    ensure_tmp_dir()
+    global _last_sweep
     now = time.time()
+    if now - _last_sweep < _SWEEP_INTERVAL_SECONDS:
+        return 0
+    _last_sweep = now
+
+    ensure_tmp_dir()
     removed = 0
 
-    for p in TMP_DIR.glob("*.pdf"):
-        try:
-            mtime = p.stat().st_mtime
-            if now - mtime > TMP_TTL_SECONDS:
-                p.unlink(missing_ok=True)
-                removed += 1
-        except Exception:
-            continue
+    # scandir: mtime берём из закэшированного DirEntry.stat, без второго stat'а
+    with os.scandir(TMP_DIR) as it:
+        for e in it:
+            try:
+                if e.name.endswith(".pdf") and now - e.stat().st_mtime > TMP_TTL_SECONDS:
+                    os.unlink(e.path)
+                    removed += 1
+            except OSError:
+                continue
 
     return removed
 
@@ -103,15 +114,19 @@ def get_upload_meta(upload_id: str) -> dict | None:
         return None
     return {"id": row[0], "name": row[1], "path": row[2], "created_at": row[3]}
 
-def list_uploads(limit: int = 200) -> list[dict]:
+def list_uploads(limit: int = 200, include_parsed: bool = False) -> list[dict]:
     """
     Возвращает ТОЛЬКО сохранённые (committed) файлы.
     Временные в историю не попадают.
+
+    parsed_json тянем только по запросу (сборка отчёта): для /history это
+    мегабайты лишнего JSON'а из БД ради имени и даты.
     """
+    parsed_col = ", parsed_json" if include_parsed else ""
     with db_conn() as conn:
         cur = conn.execute(
-            """
-            SELECT id, original_name, stored_path, created_at
+            f"""
+            SELECT id, original_name, stored_path, created_at{parsed_col}
             FROM uploads
             WHERE is_committed = 1
             ORDER BY created_at DESC
@@ -126,7 +141,8 @@ def list_uploads(limit: int = 200) -> list[dict]:
             "id": r[0],
             "name": r[1],
             "path": r[2],
-            "created_at": r[3]
+            "created_at": r[3],
+            "parsed_json": r[4] if include_parsed else None
         }
         for r in rows
     ]
@@ -148,43 +164,56 @@ def commit_uploads(ids: list[str]) -> dict:
     - обновляет stored_path и is_committed=1 в БД
     """
     ensure_perm_dir()
-    moved = 0
     missing = []
 
+    if not ids:
+        return {"moved": 0, "missing": missing}
+
     with db_conn() as conn:
+        # один SELECT на всю пачку вместо запроса на каждый id
+        qmarks = ",".join("?" * len(ids))
+        cur = conn.execute(
+            f"SELECT id, stored_path, is_committed FROM uploads WHERE id IN ({qmarks})",
+            ids
+        )
+        found = {r[0]: (r[1], int(r[2] or 0)) for r in cur.fetchall()}
+
+        updates = []  # (stored_path, parsed_json, id)
         for upload_id in ids:
-            cur = conn.execute(
-                "SELECT stored_path, original_name, is_committed FROM uploads WHERE id=?",
-                (upload_id,)
-            )
-            row = cur.fetchone()
-            if not row:
+            row = found.get(upload_id)
+            if row is None:
                 missing.append(upload_id)
                 continue
 
-            old_path, original_name, is_committed = row[0], row[1], int(row[2] or 0)
+            old_path, is_committed = row
             if is_committed == 1:
                 continue  # уже сохранён
 
-            old_p = Path(old_path)
-            if not old_p.is_file():
+            new_path = PERM_DIR / f"{upload_id}.pdf"
+            # TMP_DIR и PERM_DIR лежат на одной ФС — атомарный rename одним
+            # syscall'ом, без stat'ов и copy-fallback'а shutil.move;
+            # пропавший файл ловим по ошибке вместо предварительного is_file
+            try:
+                os.replace(old_path, new_path)
+            except OSError:
                 missing.append(upload_id)
                 continue
 
-            new_path = PERM_DIR / f"{upload_id}.pdf"
+            # Парсим один раз при коммите — отчёты потом читают готовый JSON
             try:
-                shutil.move(str(old_p), str(new_path))
+                parsed_json = json.dumps(parse_report_pdf(new_path.read_bytes()), ensure_ascii=False)
             except Exception:
-                # если move не вышел, считаем как missing
-                missing.append(upload_id)
-                continue
+                parsed_json = None
+
+            updates.append((str(new_path), parsed_json, upload_id))
 
-            conn.execute(
-                "UPDATE uploads SET stored_path=?, is_committed=1 WHERE id=?",
-                (str(new_path), upload_id)
+        if updates:
+            # одна пачка UPDATE в одной транзакции
+            conn.executemany(
+                "UPDATE uploads SET stored_path=?, is_committed=1, parsed_json=? WHERE id=?",
+                updates
             )
-            moved += 1
 
         conn.commit()
 
-    return {"moved": moved, "missing": missing}
\ No newline at end of file
+    return {"moved": len(updates), "missing": missing}
\ No newline at end of file